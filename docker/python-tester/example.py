@@ -3,8 +3,10 @@
 import re, time
 from testlib import *
 
+HASH_PATTERN = re.compile(r"[a-fA-F\d]{64}")
+
 def is_hash(input):
-    return len(re.findall(r"([a-fA-F\d]{64})", input)) == 1
+    return HASH_PATTERN.fullmatch(input.strip()) is not None
 
 execute_tests([
     # Wait for the JSONRPC interface to be up (will retry every 2 seconds up to 10 times)
@@ -15,8 +17,8 @@ execute_tests([
     # Sleep for 0 seconds. Yes, it does nothing, it's here only as an example.
     wait(0),
 
-    # Open a TCP connection to the local JSONRPC server
-    tcp_connect("127.0.0.1", 21338),
+    # Open a TCP connection to the local JSONRPC server, failing any read that gets no message within 60 seconds
+    tcp_connect("127.0.0.1", 21338, read_timeout=60),
 
     # Compose a JSONRPC message for subscribing to new blocks
     jsonrpc_request("witnet_subscribe", ["blocks"]),
@@ -27,8 +29,9 @@ execute_tests([
     # Check if the a subscription ID was returned
     jsonrpc_check_result(lambda id: int(id) > 0),
 
-    # Wait for the first block notification, which signals that we are in sync
-    wait_for_next_block(),
+    # Wait for the first block notification, which signals that we are in sync. Syncing can take much longer than
+    # the read timeout, so this wait gets its own deadline of 1 hour
+    wait_for_next_block(timeout=3600),
 
     # Read a raw JSONRPC message from a file
     read_file("/requests/bitcoin_price.json"),
@@ -47,20 +50,20 @@ execute_tests([
     json_parse,
     # Put it into context
     into_context("bitcoin_price"),
-    # Wait for a block that contains at least one data request, or fail after 3 blocks
-    wait_for_next_block(3, block_contains_dr),
+    # Wait for a block that contains at least one data request, or fail after 3 blocks or 3 minutes
+    wait_for_next_block(3, block_contains_dr, timeout=180),
     # Bring the request from the context
     from_context("bitcoin_price"),
-    # Wait for a block that contains enough commitments for the data request, or fail after 3 blocks
-    wait_for_next_block(3, block_contains_commitments_for_dr),
+    # Wait for a block that contains enough commitments for the data request, or fail after 3 blocks or 3 minutes
+    wait_for_next_block(3, block_contains_commitments_for_dr, timeout=180),
     # Bring the request from the context
     from_context("bitcoin_price"),
-    # Wait for a block that contains enough reveals for the data request, or fail after 3 blocks
-    wait_for_next_block(3, block_contains_reveals_for_dr),
+    # Wait for a block that contains enough reveals for the data request, or fail after 3 blocks or 3 minutes
+    wait_for_next_block(3, block_contains_reveals_for_dr, timeout=180),
     # Bring the request from the context
     from_context("bitcoin_price"),
-    # Wait for a block that contains enough tally for the data request, or fail after 3 blocks
-    wait_for_next_block(3, block_contains_tally_for_dr),
+    # Wait for a block that contains enough tally for the data request, or fail after 3 blocks or 3 minutes
+    wait_for_next_block(3, block_contains_tally_for_dr, timeout=180),
 
     # Close the TCP connection nicely
     tcp_disconnect,
@@ -1,21 +1,8 @@
 #!/usr/bin/env python3
 
 class Result(object):
-    def and_then(self, b_function):
-        return b_function(self.value) if isinstance(self, Ok) else self
-
-    def get_or(self, default_function):
-        return self.value if isinstance(self, Ok) else default_function(self)
-
-    def map(self, map_function):
-        return Ok(map_function(self.value)) if isinstance(self, Ok) else self
+    __slots__ = ()
 
-    def map_error(self, map_function):
-        return Err(map_function(self.error)) if isinstance(self, Err) else self
-
-    def or_else(self, b_function):
-        return self if isinstance(self, Ok) else b_function(self.error)
-    
     def unwrap(self):
         return self.value
 
@@ -23,13 +10,47 @@ class Result(object):
         return self.error
 
     def inspect(self):
-        print(self.__dict__)
+        print({name: getattr(self, name) for name in self.__slots__})
         return self
 
 class Ok(Result):
+    __slots__ = ('value',)
+
     def __init__(self, value):
         self.value = value
 
+    def and_then(self, b_function):
+        return b_function(self.value)
+
+    def get_or(self, default_function):
+        return self.value
+
+    def map(self, map_function):
+        return Ok(map_function(self.value))
+
+    def map_error(self, map_function):
+        return self
+
+    def or_else(self, b_function):
+        return self
+
 class Err(Result):
+    __slots__ = ('error',)
+
     def __init__(self, error):
-        self.error = error
\ No newline at end of file
+        self.error = error
+
+    def and_then(self, b_function):
+        return self
+
+    def get_or(self, default_function):
+        return default_function(self)
+
+    def map(self, map_function):
+        return self
+
+    def map_error(self, map_function):
+        return Err(map_function(self.error))
+
+    def or_else(self, b_function):
+        return b_function(self.error)
\ No newline at end of file
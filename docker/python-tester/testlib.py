@@ -1,12 +1,68 @@
 #!/usr/bin/env python3
 
-import json, os, socket, sys, time
+import glob, json, selectors, socket, sys, time
 from contextlib import closing
 from result import *
 
-context = {
-    'last_id': 0
-}
+# orjson is much faster than the standard library at parsing large block notifications, but it is optional.
+# Encoding always goes through the standard library, as orjson is stricter about what it accepts.
+try:
+    import orjson
+
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
+class TestContext(object):
+    __slots__ = ('sock', 'selector', 'rxbuf', 'rx_pos', 'rx_filled', 'last_id', 'read_timeout', 'store')
+
+    def __init__(self, read_timeout=None):
+        self.sock = None
+        self.selector = None
+        self.rxbuf = bytearray(65536)
+        self.rx_pos = 0
+        self.rx_filled = 0
+        self.last_id = 0
+        # Maximum number of seconds to wait for a single incoming message, or None for waiting forever
+        self.read_timeout = read_timeout
+        # Values stored by tests through into_context, keyed by name
+        self.store = {}
+
+    # Item access mirrors the dict this class replaced: 'sock' and 'last_id' map to the attributes, as they were
+    # the only connection state that dict held, and any other key maps to the values stored by tests
+    def keys(self):
+        keys = ['last_id'] if self.sock is None else ['sock', 'last_id']
+        keys.extend(self.store)
+        return keys
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def __contains__(self, key):
+        if key in TEST_CONTEXT_STATE:
+            return key == 'last_id' or self.sock is not None
+        return key in self.store
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __getitem__(self, key):
+        if key in TEST_CONTEXT_STATE:
+            return getattr(self, key)
+        return self.store[key]
+
+    def __setitem__(self, key, value):
+        if key in TEST_CONTEXT_STATE:
+            setattr(self, key, value)
+        else:
+            self.store[key] = value
+
+TEST_CONTEXT_STATE = frozenset(('sock', 'last_id'))
+
+context = TestContext()
 
 def print_success_banner(_):
     print(r''' _____                             _ 
@@ -21,16 +77,19 @@ def abort(_):
     sys.exit(1)
 
 def execute_tests(tests, prev=Ok(())):
-    if isinstance(tests, list) and len(tests) > 0:
-        result = prev.and_then(lambda v: execute_test(tests[0], v))
+    # Any failure aborts the run, so every step is fed the value of a successful one
+    prev.or_else(abort)
+    for test in tests:
+        prev = execute_test(test, prev.unwrap())
         prev.or_else(abort)
-        return execute_tests(tests[1:], result)
-    else:
-        prev.and_then(print_success_banner)
-        return tests
+
+    prev.and_then(print_success_banner)
+
+    return prev
 
 def execute_test(test, prev):
-    print("[ %s ]\nRunning test '%s'..." % (test.__name__, test.__name__))
+    name = test.__name__
+    print("[ %s ]\nRunning test '%s'..." % (name, name))
     result = test(prev)
     
     result_string = result.map(lambda v: "✔ Ok: %s" % str(v)).get_or(lambda v: "✘ Err: %s" % v.unwrap_error())
@@ -49,33 +108,49 @@ def wait(seconds):
 
 def process_is_running(process_name):
     def process_is_running(prev):
-        ps = os.popen("ps -Af").read()
-        count = ps.count(process_name)
+        for path in glob.iglob('/proc/[0-9]*/cmdline'):
+            try:
+                with open(path, 'rb') as file:
+                    cmdline = file.read().replace(b'\0', b' ').decode('utf8', 'replace')
+            except OSError:
+                # The process may have exited since the directory was listed
+                continue
 
-        if count > 0:
-            return Ok(f"process '{process_name}' is running")
-        else:
-            return Err(f"process '{process_name}' is not running")
+            if process_name in cmdline:
+                return Ok(f"process '{process_name}' is running")
+
+        return Err(f"process '{process_name}' is not running")
 
     return process_is_running
 
-def port_is_up(ip, port):
+def port_is_up(ip, port, timeout=0.25):
     def port_is_up(prev):
         with closing(socket.socket(socket.AF_INET, socket.SOCK_STREAM)) as sock:
-            connection_result = sock.connect_ex((ip, port))
-            if connection_result == 0:
+            sock.settimeout(timeout)
+            try:
+                sock.connect((ip, port))
                 return Ok(f"server at {ip}:{port} is up")
-            else:
-                return Err(f"server at {ip}:{port} is NOT up")
+            except OSError as e:
+                return Err(f"server at {ip}:{port} is NOT up ({e})")
 
     return port_is_up
 
-def tcp_connect(ip, port):
+def tcp_connect(ip, port, read_timeout=None):
     def tcp_connect(prev):
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # Send small JSON-RPC requests right away instead of waiting for Nagle's algorithm to coalesce them,
+        # and use larger buffers so that big block notifications need fewer reads
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 1 << 20)
         connection_result = sock.connect_ex((ip, port))
         if connection_result == 0:
-            context['sock'] = sock
+            context.sock = sock
+            context.read_timeout = read_timeout
+            context.selector = selectors.DefaultSelector()
+            context.selector.register(sock, selectors.EVENT_READ)
+            context.rx_pos = 0
+            context.rx_filled = 0
             return Ok(f"successful TCP connection to {ip}:{port}")
         else:
             return Err(f"failed to open TCP connection to {ip}:{port}")
@@ -83,33 +158,55 @@ def tcp_connect(ip, port):
     return tcp_connect
 
 def tcp_disconnect(prev):
-    sock = context.get('sock')
+    sock = context.sock
     peer = sock.getpeername()
+    context.selector.close()
     sock.close()
 
     return Ok("connection to %s:%i was closed orderly" % peer)
 
 def read_file(path):
     def read_file(prev):
-        with open(path) as file:
-            for line in file:
-                return Ok(line)
-
-        return Err(f"file at '{request_name}' couldn't be open")
+        try:
+            with open(path) as file:
+                content = file.read().strip()
+        except OSError as e:
+            return Err(f"file at '{path}' couldn't be open. Trace: {e}")
+
+        if content:
+            return Ok(content)
+        else:
+            return Err(f"file at '{path}' is empty")
     
     return read_file
 
 def json_parse(prev):
     try:
-        return Ok(json.loads(prev))
+        return Ok(json_loads(prev))
     except ValueError as e:
         return Err(f"couldn't parse input string as JSON. Trace: {e}")
     except:
         return Err("couldn't parse input string as JSON")
 
+def write_frame(data):
+    context.sock.sendall(data + b'\n')
+
 def jsonrpc_write(prev):
-    sock = context.get('sock')
-    sock.sendall(prev.strip().encode() + b'\n')
+    sock = context.sock
+    if isinstance(prev, str):
+        prev = prev.encode()
+    prev = prev.strip()
+    if not prev:
+        return Err("refusing to send an empty request")
+
+    # The server splits requests on newlines, so multi-line JSON needs to be compacted into a single line
+    if b'\n' in prev:
+        try:
+            prev = json.dumps(json_loads(prev)).encode()
+        except ValueError as e:
+            return Err(f"couldn't compact multi-line request into a single line. Trace: {e}")
+
+    write_frame(prev)
 
     return Ok("sent request to %s:%i" % sock.getpeername())
 
@@ -130,45 +227,145 @@ def jsonrpc_success(prev):
     return jsonrpc_check_result(lambda result: result == True)(prev)
 
 def jsonrpc_request(method, params):
+    # Method and params are fixed when the test plan is built, so only the id needs to be serialized on each call
+    prefix = '{"jsonrpc": "2.0", "method": %s, "params": %s, "id": ' % (json.dumps(method), json.dumps(params))
+
     def jsonrpc_request(prev):
-        id = context['last_id']
-        context['last_id'] = context['last_id'] + 1
-        req = {'jsonrpc': '2.0', 'method': method, 'params': params, 'id': id }
+        id = context.last_id
+        context.last_id = id + 1
 
-        return Ok(json.dumps(req))
+        return Ok(prefix + str(id) + '}')
 
     return jsonrpc_request
 
+def read_frame(deadline=None):
+    # Reads the next newline-delimited frame received through the socket in context. Bytes past the end of
+    # the frame are kept in the receive buffer for the next call, so coalesced messages are never lost.
+    # If no deadline is given, the read times out after context.read_timeout seconds.
+    if deadline is None and context.read_timeout is not None:
+        deadline = time.monotonic() + context.read_timeout
+
+    sock = context.sock
+    selector = context.selector
+    buf = context.rxbuf
+    pos = context.rx_pos
+    filled = context.rx_filled
+
+    while True:
+        end = buf.find(b'\n', pos, filled)
+        if end >= 0:
+            context.rx_pos = end + 1
+            context.rx_filled = filled
+            # Both json.loads and orjson.loads accept a bytearray, so the slice is the only copy made
+            frame = buf[pos:end]
+            if frame and not frame.isspace():
+                return Ok(frame)
+            pos = end + 1
+            continue
+
+        # Move the partial frame to the start of the buffer, and grow it if the frame does not fit
+        if pos > 0:
+            buf[:filled - pos] = buf[pos:filled]
+            filled = filled - pos
+            pos = 0
+        context.rx_pos = pos
+        context.rx_filled = filled
+        if filled == len(buf):
+            buf.extend(bytes(len(buf)))
+
+        timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+        if not selector.select(timeout):
+            return Err("timed out while waiting for a message")
+
+        with memoryview(buf) as view:
+            received = sock.recv_into(view[filled:])
+        if received == 0:
+            return Err("connection was closed by the peer")
+        filled = filled + received
+
+def read_message(deadline=None):
+    try:
+        return read_frame(deadline).map(json_loads)
+    except ValueError as e:
+        return Err(f"couldn't parse response as JSON. Trace: {e}")
 
 def jsonrpc_read(prev):
-    sock = context.get('sock')
-    raw = sock.recv(20000)
-    res = json.loads(raw.decode('utf8'))
+    return read_message()
+
+def jsonrpc_batch(calls, timeout=None):
+    calls = list(calls)
+    if not calls:
+        raise ValueError("jsonrpc_batch needs at least one call, as empty batches are rejected by the server")
+
+    def jsonrpc_batch(prev):
+        ids = []
+        reqs = []
+        for method, params in calls:
+            id = context.last_id
+            context.last_id = id + 1
+            ids.append(id)
+            reqs.append({'jsonrpc': '2.0', 'method': method, 'params': params, 'id': id })
+
+        write_frame(json.dumps(reqs).encode())
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        while True:
+            res = read_message(deadline)
+            if isinstance(res, Err):
+                return res
+
+            res = res.unwrap()
+            if isinstance(res, list):
+                break
+
+            # An invalid batch is answered with a single error object with a null id instead of an array
+            if isinstance(res, dict) and 'error' in res and res.get('id') is None:
+                return Err("batch request failed. Error was: %s" % res.get('error'))
+            else:
+                print("\tIgnored this message while waiting for batch response: %s" % str(res))
 
-    return Ok(res)
+        by_id = {r.get('id'): r for r in res if isinstance(r, dict)}
+        missing = [id for id in ids if id not in by_id]
+        if missing:
+            return Err(f"batch response is missing responses for ids {missing}")
 
-def wait_for_next_block(max_retries = 0, filter_function = lambda block, prev: Ok(block)):
-    def wait_for_next_block(prev, retries_left=max_retries):
-        def retry(checkpoint, reason, retries_left):
-            if retries_left > 1:
-                retries_left = retries_left - 1
-                print(f"\tIgnoring block for checkpoint {checkpoint} because {reason}. {retries_left} retries left")
-                return wait_for_next_block(prev, retries_left)
-            else:
-                return Err(f"couldn't find a block passing the filter after {max_retries} retries")
+        return Ok([by_id[id] for id in ids])
+
+    jsonrpc_batch.__name__ = f"{jsonrpc_batch.__name__}({', '.join(method for method, _ in calls)})"
+
+    return jsonrpc_batch
+
+def any_block(block, prev):
+    return Ok(block)
+
+def wait_for_next_block(max_retries = 0, filter_function = any_block, timeout = None):
+    def wait_for_next_block(prev):
+        retries_left = max_retries
+        deadline = None if timeout is None else time.monotonic() + timeout
 
-        def decide(res):
-            if 'params' in res and isinstance(res['params'], dict) and 'result' in res['params'] and isinstance(res['params']['result'], dict) and 'block_header' in res['params']['result']:
+        while True:
+            res = read_message(deadline)
+            if isinstance(res, Err):
+                return res
+
+            res = res.unwrap()
+            try:
                 block = res['params']['result']
                 checkpoint = block['block_header']['beacon']['checkpoint']
-                return filter_function(block, prev).or_else(lambda reason: retry(checkpoint, reason, retries_left))
-            else:
+            except (KeyError, TypeError):
                 print("\tIgnored this message while waiting for next block: %s" % str(res))
-                return wait_for_next_block(prev)
-            
-        return jsonrpc_read(prev).and_then(decide)
+                continue
+
+            result = filter_function(block, prev)
+            if isinstance(result, Ok):
+                return result
+            elif retries_left > 1:
+                retries_left = retries_left - 1
+                print(f"\tIgnoring block for checkpoint {checkpoint} because {result.unwrap_error()}. {retries_left} retries left")
+            else:
+                return Err(f"couldn't find a block passing the filter after {max_retries} retries")
 
-    wait_for_next_block.__name__ = f'{wait_for_next_block.__name__}({filter_function.__name__})'
+    wait_for_next_block.__name__ = f'wait_for_next_block({filter_function.__name__})'
 
     return wait_for_next_block
 
@@ -177,91 +374,81 @@ def block_contains_dr(block, request):
         checkpoint = block['block_header']['beacon']['checkpoint']
         drs = block['txns']['data_request_txns']
         if len(drs) > 0:
-            matches = [dr for dr in drs if dr['body']['dr_output'] == request['params']['dro']]
-            if len(matches) > 0:
+            dro = request['params']['dro']
+            if any(dr['body']['dr_output'] == dro for dr in drs):
                 return Ok(block)
             else:
                 return Err(f"the data request was not included")
         else:
             return Err("there are no data requests inside")
-    except:
-        return Err(f"unknown error.\n\tBlock was {str(block)}\n\tRequest was {str(request)}")
+    except (KeyError, TypeError) as e:
+        return Err(f"missing or malformed field {e}.\n\tBlock was {str(block)}\n\tRequest was {str(request)}")
 
 def block_contains_commitments_for_dr(block, request):
     try:
         checkpoint = block['block_header']['beacon']['checkpoint']
-        commits = block['txns']['commit_txns']
-        if len(commits) > 0:
-            matches = [tx for tx in commits if True]
-            if len(matches) > 0:
-                rf = request['params']['dro']['witnesses']
-                if len(matches) >= rf:
-                    return Ok(block)
-                else:
-                    return Err(f"there are not enough commitments ({len(matches)} < {rf})")
-            else:
-                return Err(f"there are no commitments for the specific data request")
-        else:
+        commits = len(block['txns']['commit_txns'])
+        rf = request['params']['dro']['witnesses']
+        if commits == 0:
             return Err("there are no commitments inside")
+        elif commits < rf:
+            return Err(f"there are not enough commitments ({commits} < {rf})")
+        else:
+            return Ok(block)
     except ValueError as e:
         return Err(f"ValueError: {e}")
-    except:
-        return Err(f"unknown error.\n\tBlock was {str(block)}\n\tRequest was {str(request)}")
+    except (KeyError, TypeError) as e:
+        return Err(f"missing or malformed field {e}.\n\tBlock was {str(block)}\n\tRequest was {str(request)}")
 
 def block_contains_reveals_for_dr(block, request):
     try:
         checkpoint = block['block_header']['beacon']['checkpoint']
-        reveals = block['txns']['reveal_txns']
-        if len(reveals) > 0:
-            matches = [tx for tx in reveals if True]
-            if len(matches) > 0:
-                rf = request['params']['dro']['witnesses']
-                if len(matches) >= rf:
-                    return Ok(block)
-                else:
-                    return Err(f"there are not enough reveals ({len(matches)} < {rf})")
-            else:
-                return Err(f"there are no reveals for the specific data request")
-        else:
+        reveals = len(block['txns']['reveal_txns'])
+        rf = request['params']['dro']['witnesses']
+        if reveals == 0:
             return Err("there are no reveals inside")
+        elif reveals < rf:
+            return Err(f"there are not enough reveals ({reveals} < {rf})")
+        else:
+            return Ok(block)
     except ValueError as e:
         return Err(f"ValueError: {e}")
-    except:
-        return Err(f"unknown error.\n\tBlock was {str(block)}\n\tRequest was {str(request)}")
+    except (KeyError, TypeError) as e:
+        return Err(f"missing or malformed field {e}.\n\tBlock was {str(block)}\n\tRequest was {str(request)}")
 
 def block_contains_tally_for_dr(block, request):
     try:
         checkpoint = block['block_header']['beacon']['checkpoint']
-        tallies = block['txns']['tally_txns']
-        if len(tallies) > 0:
-            matches = [tx for tx in tallies if True]
-            if len(matches) == 1:
-                return Ok(block)
-            elif len(matches) > 1:
-                return Err(f"there are too many tallies for the specific data request ({len(matches)})")
-            else:
-                return Err("there is no tally for the specific data request")
+        tallies = len(block['txns']['tally_txns'])
+        if tallies == 1:
+            return Ok(block)
+        elif tallies > 1:
+            return Err(f"there are too many tallies for the specific data request ({tallies})")
         else:
             return Err("there are no tallies inside")
     except ValueError as e:
         return Err(f"ValueError: {e}")
-    except:
-        return Err(f"unknown error.\n\tBlock was {str(block)}\n\tRequest was {str(request)}")
+    except (KeyError, TypeError) as e:
+        return Err(f"missing or malformed field {e}.\n\tBlock was {str(block)}\n\tRequest was {str(request)}")
 
 def poll(inner_function, period=1, max_retries=5):
-    def poll(prev, retries_left=max_retries):
-        def retry(reason, retries_left=max_retries):
-            if retries_left > 1:
+    name = inner_function.__name__
+
+    def poll(prev):
+        retries_left = max_retries
+
+        while True:
+            result = inner_function(prev)
+            if isinstance(result, Ok):
+                return result
+            elif retries_left > 1:
                 retries_left = retries_left - 1
-                print(f"\tWill retry test '{inner_function.__name__}' in {period}s because {reason}. {retries_left} retries left")
+                print(f"\tWill retry test '{name}' in {period}s because {result.unwrap_error()}. {retries_left} retries left")
                 time.sleep(period)
-                return poll(prev, retries_left)
             else:
-                return Err(f"test '{inner_function.__name__}' didn't succeed after {max_retries} retries")
-
-        return inner_function(prev).or_else(lambda reason: retry(reason, retries_left))
+                return Err(f"test '{name}' didn't succeed after {max_retries} retries")
 
-    poll.__name__ = inner_function.__name__
+    poll.__name__ = name
 
     return poll
 